@@ -1,7 +1,14 @@
+import base64
+import collections
+import contextlib
 import datetime
 import dateutil
+import gzip
 import json
+import os
 import re
+import sys
+import threading
 import time
 
 import boto3
@@ -11,6 +18,449 @@ import jsonrpcclient
 import requests
 
 
+class ReplayedTransportError(Exception):
+    """
+    Raised in replay mode when a recorded call failed with an exception we
+    can't rebuild, or when the archive has no response left for a request.
+
+    If the recorded exception had a `message` attribute (as jsonrpcclient's
+    errors do) it is set here too, so code like AltNetTestnetRippleAPIHandler
+    takes the same path on replay as it did live.
+    """
+
+
+class Transport:
+    """
+    Every network call made while polling (the IMS fetch and the public block
+    explorers) goes through an instance of this class so that a run can be
+    recorded to disk and replayed offline later.
+
+    Modes:
+    - `live`: plain passthrough to `requests` / `jsonrpcclient`.
+    - `record`: passthrough, but every response (or exception) is saved along
+      with how long it took. Call `save()`, or use the transport as a context
+      manager, to write the archive.
+    - `replay`: no network at all; responses are served from the archive in
+      the order they were recorded for each URL. `speed` scales the recorded
+      latencies (2.0 = twice as fast, 0 = no waiting at all).
+
+    The archive is a gzipped JSON document: a header with the time the run was
+    recorded and a list of entries, one per call, with bodies base64 encoded.
+    """
+    MODES = ('live', 'record', 'replay')
+
+    def __init__(self, mode='live', archive_path=None, speed=1.0):
+        if mode not in self.MODES:
+            raise ValueError('Unknown transport mode: {}'.format(mode))
+        if mode != 'live' and not archive_path:
+            raise ValueError('An archive path is required in {} mode'.format(mode))
+        if speed < 0:
+            raise ValueError('Replay speed can not be negative: {}'.format(speed))
+        self.mode = mode
+        self.archive_path = archive_path
+        self.speed = speed
+        self.recorded_at = None
+        self.entries = []
+        self._replay_queues = collections.defaultdict(collections.deque)
+
+        if mode == 'replay':
+            self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Save even when the run blew up; failed runs are the ones worth
+        # replaying
+        self.save()
+
+    def _load(self):
+        with gzip.open(self.archive_path, 'rt') as archive:
+            data = json.load(archive)
+        self.recorded_at = data['recordedAt']
+        self.entries = data['entries']
+        for entry in self.entries:
+            self._replay_queues[(entry['kind'], entry['url'])].append(entry)
+
+    def save(self):
+        """
+        Writes everything captured so far to the archive. A no-op unless we
+        are recording.
+        """
+        if self.mode != 'record':
+            return
+        data = {
+            'recordedAt': self.recorded_at,
+            'entries': self.entries,
+        }
+        with gzip.open(self.archive_path, 'wt') as archive:
+            json.dump(data, archive, separators=(',', ':'))
+
+    def now(self, tz):
+        """
+        The time the run is happening at; in replay mode this is the time the
+        archive was recorded so output file names and `dateFetched` match.
+        """
+        if self.mode == 'replay':
+            return datetime.datetime.fromtimestamp(self.recorded_at, tz=tz)
+        current_time = datetime.datetime.now(tz=tz)
+        if self.mode == 'record':
+            self.recorded_at = current_time.timestamp()
+        return current_time
+
+    def sleep(self, seconds):
+        """
+        Waits between retries. Replay scales the wait like any other latency.
+        """
+        if self.mode == 'replay':
+            seconds = self._scaled(seconds)
+        if seconds:
+            time.sleep(seconds)
+
+    def get(self, url, timeout):
+        """
+        Drop-in for `requests.get(url, timeout=timeout)`.
+        """
+        if self.mode == 'replay':
+            entry = self._next_entry('http', url)
+            response = requests.models.Response()
+            response.url = url
+            response.status_code = entry['statusCode']
+            response._content = base64.b64decode(entry['content'])
+            return response
+        return self._call('http', url, lambda: requests.get(url, timeout=timeout))
+
+    def jsonrpc_request(self, url, method):
+        """
+        Drop-in for `jsonrpcclient.request(url, method)`.
+        """
+        if self.mode == 'replay':
+            entry = self._next_entry('jsonrpc', url)
+            if 'resultText' in entry:
+                return ReplayedJSONRPCResponse(entry['resultText'])
+            return entry['result']
+        return self._call('jsonrpc', url, lambda: jsonrpcclient.request(url, method))
+
+    def _call(self, kind, url, send):
+        if self.mode == 'live':
+            return send()
+
+        entry = {
+            'kind': kind,
+            'url': url,
+        }
+        start = time.time()
+        try:
+            result = send()
+        except Exception as e:
+            entry['elapsed'] = round(time.time() - start, 3)
+            entry['error'] = {
+                'type': _error_type(type(e)),
+                'message': str(getattr(e, 'message', e)),
+                'hasMessage': hasattr(e, 'message'),
+            }
+            self.entries.append(entry)
+            raise
+        entry['elapsed'] = round(time.time() - start, 3)
+        if kind == 'http':
+            entry['statusCode'] = result.status_code
+            entry['content'] = base64.b64encode(result.content).decode('ascii')
+        else:
+            entry.update(_jsonrpc_result_entry(result))
+        self.entries.append(entry)
+        return result
+
+    def _next_entry(self, kind, url):
+        queue = self._replay_queues[(kind, url)]
+        if not queue:
+            raise ReplayedTransportError('No recorded {} response left for {}'.format(kind, url))
+        entry = queue.popleft()
+        self.sleep(entry['elapsed'])
+        if 'error' in entry:
+            raise self._rebuild_error(entry['error'])
+        return entry
+
+    def _scaled(self, seconds):
+        if not self.speed:
+            return 0
+        return seconds / self.speed
+
+    @staticmethod
+    def _rebuild_error(error):
+        """
+        Recreates the exceptions `lambda_handler` actually branches on so a
+        replayed run takes the same path as the recorded one; anything else
+        comes back as a ReplayedTransportError.
+        """
+        message = error['message']
+        if error['type'] == _error_type(ReadTimeout):
+            return ReadTimeout(message)
+        if error['type'] == _error_type(ConnectionError):
+            return ConnectionError(error=message)
+        replayed_error = ReplayedTransportError(message)
+        if error.get('hasMessage'):
+            replayed_error.message = message
+        return replayed_error
+
+
+class ReplayedJSONRPCResponse:
+    """
+    Stands in for the response object newer jsonrpcclient versions return from
+    `request()`, rebuilt from the raw text saved in the archive.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.data = collections.namedtuple('ReplayedJSONRPCData', ['result'])(
+            json.loads(text).get('result') if text else None)
+
+
+def _error_type(exception_class):
+    return '{}.{}'.format(exception_class.__module__, exception_class.__name__)
+
+
+def _jsonrpc_result_entry(result):
+    """
+    Depending on its version, jsonrpcclient returns either the plain result or
+    a Response object; keep the raw text of the latter so the archive stays
+    JSON serializable.
+    """
+    if hasattr(result, 'text'):
+        return {'resultText': result.text}
+    try:
+        json.dumps(result)
+    except TypeError:
+        return {'resultText': None}
+    return {'result': result}
+
+
+def get_transport(event):
+    """
+    Builds the Transport for a run from the invocation event, falling back to
+    environment variables so record/replay can be switched on for a deployed
+    function without touching its trigger:
+
+    - `transportMode` / INDEXER_HEALTH_TRANSPORT_MODE: live, record or replay
+    - `transportArchive` / INDEXER_HEALTH_TRANSPORT_ARCHIVE: archive path
+    - `replaySpeed` / INDEXER_HEALTH_REPLAY_SPEED: latency divisor (0 = instant)
+    """
+    mode, archive_path = _transport_mode_and_archive(event)
+    if isinstance(event, dict) and event.get('replaySpeed') is not None:
+        speed = event['replaySpeed']
+    else:
+        speed = os.environ.get('INDEXER_HEALTH_REPLAY_SPEED', 1.0)
+    return Transport(mode=mode, archive_path=archive_path, speed=float(speed))
+
+
+def _transport_mode_and_archive(event):
+    if not isinstance(event, dict):
+        event = {}
+    mode = event.get('transportMode') or os.environ.get('INDEXER_HEALTH_TRANSPORT_MODE', 'live')
+    archive_path = event.get('transportArchive') or os.environ.get(
+        'INDEXER_HEALTH_TRANSPORT_ARCHIVE', '/tmp/indexer-health-transport.json.gz')
+    return mode, archive_path
+
+
+def get_output_dir(event):
+    """
+    Returns the local directory the JSON files should be written to, or None
+    to publish them to s3 as usual. Set via `outputDir` in the event or
+    INDEXER_HEALTH_OUTPUT_DIR; replayed runs never touch s3 and default to the
+    directory holding the archive.
+    """
+    mode, archive_path = _transport_mode_and_archive(event)
+    if not isinstance(event, dict):
+        event = {}
+    output_dir = event.get('outputDir') or os.environ.get('INDEXER_HEALTH_OUTPUT_DIR')
+    if not output_dir and mode == 'replay':
+        output_dir = os.path.dirname(os.path.abspath(archive_path))
+    return output_dir
+
+
+# Flipped after the first invocation in a container so profiles can tell cold
+# starts (module import, first boto3 client) apart from warm runs
+_cold_start = True
+
+
+class Profiler:
+    """
+    Opt-in, low overhead profiling for a run (see get_profiler).
+
+    While running, a background thread samples the main thread's stack every
+    `interval` seconds. Samples are wall-clock, so time spent blocked on the
+    network or sleeping between retries shows up too. Each sample is filed
+    under the stage that was active when it was taken; stages (`setup`,
+    `poll`, `parse`, `publish`) are marked with `stage()`, which also tracks
+    wall and CPU time per stage.
+
+    When disabled every method is a no-op, so callers never need to check.
+    """
+    def __init__(self, enabled=False, interval=0.005):
+        if interval <= 0:
+            # A zero wait would have the sampler spin on the GIL
+            raise ValueError('Sampling interval must be positive: {}'.format(interval))
+        self.enabled = enabled
+        self.interval = interval
+        self.cold_start = _cold_start
+        self.samples = collections.Counter()
+        self.stages = collections.OrderedDict()
+        self._current_stage = None
+        self._started = None
+        self._total = None
+        self._stopping = threading.Event()
+        self._sampler = None
+        self._main_thread_id = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        global _cold_start
+        _cold_start = False
+        if not self.enabled:
+            return
+        self._started = time.perf_counter()
+        self._main_thread_id = threading.get_ident()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        if not self.enabled or self._sampler is None:
+            return
+        self._stopping.set()
+        self._sampler.join()
+        self._sampler = None
+        self._total = time.perf_counter() - self._started
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Stages don't nest; time spent in an inner stage is already counted
+        # by the outer one
+        if not self.enabled or self._current_stage is not None:
+            yield
+            return
+
+        self._current_stage = name
+        wall_started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            yield
+        finally:
+            timings = self.stages.setdefault(name, {'calls': 0, 'wallSeconds': 0, 'cpuSeconds': 0})
+            timings['calls'] += 1
+            timings['wallSeconds'] += time.perf_counter() - wall_started
+            timings['cpuSeconds'] += time.thread_time() - cpu_started
+            self._current_stage = None
+
+    def _sample_loop(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self._main_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(self._current_stage or 'other')
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed_stacks(self):
+        """
+        The samples in collapsed-stack format (`frame;frame;frame count` per
+        line), which speedscope and flamegraph.pl both read directly.
+        """
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(self.samples.items()))
+
+    def summary(self):
+        """
+        Per-stage timings and sample counts, plus the hottest leaf frames of
+        each stage.
+        """
+        stage_samples = collections.Counter()
+        leaf_frames = collections.defaultdict(collections.Counter)
+        for stack, count in self.samples.items():
+            frames = stack.split(';')
+            stage_samples[frames[0]] += count
+            leaf_frames[frames[0]][frames[-1]] += count
+
+        stages = collections.OrderedDict()
+        for name, timings in self.stages.items():
+            stages[name] = {
+                'calls': timings['calls'],
+                'wallSeconds': round(timings['wallSeconds'], 6),
+                'cpuSeconds': round(timings['cpuSeconds'], 6),
+                'samples': stage_samples[name],
+                'topFrames': [
+                    {'frame': frame, 'samples': count} for frame, count in leaf_frames[name].most_common(5)
+                ],
+            }
+        staged_seconds = sum(timings['wallSeconds'] for timings in self.stages.values())
+        return {
+            'coldStart': self.cold_start,
+            'totalSeconds': round(self._total or 0, 6),
+            'unstagedSeconds': round((self._total or 0) - staged_seconds, 6),
+            'sampleInterval': self.interval,
+            'samples': sum(self.samples.values()),
+            'stages': stages,
+        }
+
+    def report_files(self, run_name):
+        """
+        Returns the profile as (file name, body, content type) tuples ready
+        for publish_files().
+        """
+        return [
+            ('profiles/{}.collapsed'.format(run_name), self.collapsed_stacks().encode('utf-8'), 'text/plain'),
+            ('profiles/{}-summary.json'.format(run_name), json.dumps(self.summary()).encode('utf-8'), 'application/json'),
+        ]
+
+
+def get_profiler(event):
+    """
+    Builds the Profiler for a run. Profiling is off unless `profile` in the
+    event or INDEXER_HEALTH_PROFILE is true or 1 (the event wins when set);
+    the sampling interval (seconds) can be tuned with `profileInterval` or
+    INDEXER_HEALTH_PROFILE_INTERVAL and must be positive.
+    """
+    if not isinstance(event, dict):
+        event = {}
+    enabled = event.get('profile')
+    if enabled is None:
+        enabled = os.environ.get('INDEXER_HEALTH_PROFILE', '')
+    interval = event.get('profileInterval', os.environ.get('INDEXER_HEALTH_PROFILE_INTERVAL', 0.005))
+    return Profiler(enabled=str(enabled).lower() in ('1', 'true'), interval=float(interval))
+
+
+def publish_files(files, output_dir, public=False):
+    """
+    Writes (file name, body, content type) tuples to `output_dir` if one is
+    given, otherwise to the s3 bucket. Only `public` files are world readable.
+    """
+    if output_dir:
+        for file_name, body, _ in files:
+            path = os.path.join(output_dir, file_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as output_file:
+                output_file.write(body)
+        return
+
+    bucket_name = "bitgo-indexer-health"
+    s3 = boto3.resource("s3")
+    for file_name, body, content_type in files:
+        aws_kwargs = {
+            'Body': body,
+            'ContentType': content_type,
+        }
+        if public:
+            aws_kwargs['ACL'] = 'public-read'
+        s3.Bucket(bucket_name).put_object(Key=file_name, **aws_kwargs)
+
+
 class PublicBlockExplorerHandler:
     """
     This class based function handles the calling and parsing of urls that
@@ -19,7 +469,15 @@ class PublicBlockExplorerHandler:
 
     We compare this height to the height of our internal block explorers to
     ensure that we are at or near chainhead.
+
+    All network calls go through `self.transport` (see Transport) so runs can
+    be recorded and replayed; fetching and parsing are timed as the `poll` and
+    `parse` stages of `self.profiler` (see Profiler).
     """
+    def __init__(self, transport=None, profiler=None):
+        self.transport = transport or Transport()
+        self.profiler = profiler or Profiler()
+
     def get_url_and_return_height(self, public_block_explorer_url):
         """
         Takes the URL of the public block explore and returns the height of the
@@ -29,30 +487,32 @@ class PublicBlockExplorerHandler:
         explorer specified is not available via an http + JSON request/response
         cycle.
         """
-        print(public_block_explorer_url)
-        response = requests.get(public_block_explorer_url, timeout=5)
-        print(response.status_code)
-        retry_count = 0
-        status_code = response.status_code
-        while status_code != 200:
-            time.sleep(8)
-            if retry_count > 4:
-                break
-            response = requests.get(public_block_explorer_url, timeout=5)
-            print('Retried {} times...'.format(retry_count))
+        with self.profiler.stage('poll'):
+            print(public_block_explorer_url)
+            response = self.transport.get(public_block_explorer_url, timeout=5)
             print(response.status_code)
+            retry_count = 0
             status_code = response.status_code
-            retry_count += 1
-            if status_code >= 500:
-                break
+            while status_code != 200:
+                self.transport.sleep(8)
+                if retry_count > 4:
+                    break
+                response = self.transport.get(public_block_explorer_url, timeout=5)
+                print('Retried {} times...'.format(retry_count))
+                print(response.status_code)
+                status_code = response.status_code
+                retry_count += 1
+                if status_code >= 500:
+                    break
 
         # Parse the response and return the public height of the blockchain.
         # This is where subclasses typically override behavior to handle custom
         # response parsing based on the public explorer being called.
-        try:
-            public_block_explorer_height = self.parse_request_and_return_height(response)
-        except KeyError:
-            public_block_explorer_height = 0
+        with self.profiler.stage('parse'):
+            try:
+                public_block_explorer_height = self.parse_request_and_return_height(response)
+            except KeyError:
+                public_block_explorer_height = 0
 
         return public_block_explorer_height
 
@@ -198,9 +658,11 @@ class AltNetTestnetRippleAPIHandler(PublicBlockExplorerHandler):
         This ripple testnset explorer endpoint uses jrpc.
         """
         try:
-            resp = jsonrpcclient.request(public_block_explorer_url, 'ledger_current')
+            with self.profiler.stage('poll'):
+                resp = self.transport.jsonrpc_request(public_block_explorer_url, 'ledger_current')
         except Exception as e:
-            return re.search(r'ledger_current_index\': (.*?)}}', e.message).group(1)
+            with self.profiler.stage('parse'):
+                return re.search(r'ledger_current_index\': (.*?)}}', e.message).group(1)
         return None
 
     def parse_request_and_return_height(self, response):
@@ -276,14 +738,46 @@ def lambda_handler(event, context):
     file that a front-end app will pull from).
 
     The final data structure pushed to s3 looks like: https://s3-us-west-2.amazonaws.com/bitgo-indexer-health/latest.json
-    """
-    pst = dateutil.tz.gettz('US/Pacific')
-    current_time = datetime.datetime.now(tz=pst)
 
-    # The number of blocks we allow BitGo to fall behind for a given chain
-    # before alerting the dashboard
-    BLOCKS_BEHIND_THRESHOLD = 4
+    Network traffic can be recorded and replayed offline (see get_transport);
+    replayed runs, or any run with an output dir set, write the JSON files to
+    local disk instead of s3 (see get_output_dir).
 
+    When profiling is switched on (see get_profiler), a collapsed-stack profile
+    and a per-stage summary are written under `profiles/` next to the output.
+    """
+    profiler = get_profiler(event)
+    pst = dateutil.tz.gettz('US/Pacific')
+    output_dir = get_output_dir(event)
+    # Until the transport says otherwise (replays reuse the recorded time) the
+    # run is named after the time it started, so even a run that fails during
+    # setup has somewhere to write its profile
+    run_name = "{}".format(datetime.datetime.now(tz=pst))
+    try:
+        with profiler:
+            with profiler.stage('setup'):
+                transport = get_transport(event)
+                current_time = transport.now(pst)
+                run_name = "{}".format(current_time)
+                output_data = build_output_data(current_time)
+
+            # The archive is saved on the way out, even if polling raised
+            with transport:
+                check_indexers(output_data, transport, profiler)
+
+            with profiler.stage('publish'):
+                publish_output_data(output_data, run_name, output_dir)
+    finally:
+        # Crashed runs are the ones most worth profiling, so always write it
+        if profiler.enabled:
+            publish_files(profiler.report_files(run_name), output_dir)
+
+
+def build_output_data(current_time):
+    """
+    Returns the config of every indexer we check, keyed by coin, which
+    check_indexers() fills in with each environment's status.
+    """
     # This dict acts as both a mapping of coin + env to public block explorer as
     # as the final data dict that will be jsonified and persisted to s3 once
     # values like `status`, `latestBlock`, and `blocksBehind` have been populated
@@ -579,6 +1073,17 @@ def lambda_handler(event, context):
             },
         }
     }
+    return output_data
+
+
+def check_indexers(output_data, transport, profiler):
+    """
+    Polls every indexer in `output_data` and its public block explorer,
+    filling in `status`, `latestBlock` and `blocksBehind` for each environment.
+    """
+    # The number of blocks we allow BitGo to fall behind for a given chain
+    # before alerting the dashboard
+    BLOCKS_BEHIND_THRESHOLD = 4
 
     # Iterate over the dict above and fill in the blanks:
     # 1. Hit BitGo to get the state of the indexer
@@ -599,7 +1104,8 @@ def lambda_handler(event, context):
 
             # Hit BitGo's IMS to fetch data about the most recently processed block
             try:
-                response = requests.get(env_data['bgURL'], timeout=4)
+                with profiler.stage('poll'):
+                    response = transport.get(env_data['bgURL'], timeout=4)
             # If the server took more than four seconds to respond, consider it
             # down and alert the status
             except (ConnectionError, ReadTimeout):
@@ -610,7 +1116,8 @@ def lambda_handler(event, context):
 
             print(env_data['bgURL'])
             try:
-                bg_response = json.loads(response.content)
+                with profiler.stage('parse'):
+                    bg_response = json.loads(response.content)
             except json.JSONDecodeError:
                 env_data['status'] = False
                 env_data['latestBlock'] = 'IMS Unresponsive'
@@ -643,7 +1150,7 @@ def lambda_handler(event, context):
             if env_data['network'] == 'Dev':
                 public_block_explorer_height = coin_data['environments'][1].get('referenceBlock', 0)
             else:
-                api_handler = api_handler_class()
+                api_handler = api_handler_class(transport=transport, profiler=profiler)
                 try:
                     public_block_explorer_height = api_handler.get_url_and_return_height(env_data['publicURL'])
                 except Exception as e:
@@ -661,6 +1168,12 @@ def lambda_handler(event, context):
             if (int(public_block_explorer_height) - int(bg_response['height'])) > BLOCKS_BEHIND_THRESHOLD:
                 env_data['status'] = False
 
+
+def publish_output_data(output_data, run_name, output_dir):
+    """
+    Writes the filled in `output_data` to s3 (or `output_dir`, see
+    get_output_dir()) as both a time-stamped file and `latest.json`.
+    """
     # Iterate through the dict and pop any non-json serializable objects that
     # are about to be json dump'd
     for k, v in output_data['indexers'].items():
@@ -677,18 +1190,14 @@ def lambda_handler(event, context):
     # 2. A file called 'latest' which overwrites the previously marked 'latest'
     # file. This is the file that the front-end app consumes. Overwriting it every
     # five minutes keeps the app up to date.
-    dated_file_name = "{}.json".format(current_time)
+    dated_file_name = "{}.json".format(run_name)
     latest_file_name = "latest.json"
 
-    # Write the files to the bucket
-    bucket_name = "bitgo-indexer-health"
-    s3 = boto3.resource("s3")
-    aws_kwargs = {
-        'Body': encoded_string,
-        'ACL': 'public-read',
-        'ContentType': 'application/json',
-    }
-    s3.Bucket(bucket_name).put_object(Key=dated_file_name, **aws_kwargs)
-    s3.Bucket(bucket_name).put_object(Key=latest_file_name, **aws_kwargs)
+    # Write the files to the bucket (or locally when asked to; always when
+    # replaying)
+    publish_files([
+        (dated_file_name, encoded_string, 'application/json'),
+        (latest_file_name, encoded_string, 'application/json'),
+    ], output_dir, public=True)
 
 # lambda_handler(0,0)
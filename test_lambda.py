@@ -0,0 +1,193 @@
+import gzip
+import importlib.util
+import json
+import os
+import re
+import time
+
+import pytest
+import requests
+
+
+# `lambda` is a keyword, so the module can't be imported by name
+_spec = importlib.util.spec_from_file_location(
+    'indexer_health', os.path.join(os.path.dirname(__file__), 'lambda.py'))
+indexer_health = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(indexer_health)
+
+
+def fake_response(body, status_code=200):
+    response = requests.models.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode('utf-8')
+    return response
+
+
+def fake_get(url, timeout):
+    if 'bitgo.com' in url:
+        return fake_response({'height': 100})
+    return fake_response({'blockNumber': 102, 'head_block_num': 101})
+
+
+def fake_jsonrpc_request(url, method):
+    raise Exception("{'result': {'ledger_current_index': 55}}")
+
+
+def offline_get(url, timeout):
+    raise AssertionError('Tried to hit the network in replay mode: {}'.format(url))
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    return str(tmp_path / 'run.json.gz')
+
+
+def record(monkeypatch, tmp_path, archive_path, get=fake_get):
+    monkeypatch.setattr(indexer_health.requests, 'get', get)
+    monkeypatch.setattr(indexer_health.jsonrpcclient, 'request', fake_jsonrpc_request)
+    indexer_health.lambda_handler({
+        'transportMode': 'record',
+        'transportArchive': archive_path,
+        'outputDir': str(tmp_path / 'recorded'),
+    }, None)
+
+
+def test_replay_matches_recorded_run(monkeypatch, tmp_path, archive_path):
+    record(monkeypatch, tmp_path, archive_path)
+
+    monkeypatch.setattr(indexer_health.requests, 'get', offline_get)
+    monkeypatch.setattr(indexer_health.jsonrpcclient, 'request', offline_get)
+    indexer_health.lambda_handler({
+        'transportMode': 'replay',
+        'transportArchive': archive_path,
+        'replaySpeed': 0,
+        'outputDir': str(tmp_path / 'replayed'),
+    }, None)
+
+    recorded = sorted(os.listdir(str(tmp_path / 'recorded')))
+    assert recorded == sorted(os.listdir(str(tmp_path / 'replayed')))
+    for file_name in recorded:
+        with open(str(tmp_path / 'recorded' / file_name)) as recorded_file:
+            with open(str(tmp_path / 'replayed' / file_name)) as replayed_file:
+                assert json.load(recorded_file) == json.load(replayed_file)
+
+
+def test_replay_without_recorded_response_raises(monkeypatch, tmp_path, archive_path):
+    record(monkeypatch, tmp_path, archive_path)
+
+    transport = indexer_health.Transport(mode='replay', archive_path=archive_path, speed=0)
+    with pytest.raises(indexer_health.ReplayedTransportError):
+        transport.get('https://example.com/not-recorded', timeout=5)
+
+
+def test_crashed_run_still_saves_archive(monkeypatch, tmp_path, archive_path):
+    def failing_get(url, timeout):
+        raise requests.exceptions.ConnectionError('connection refused')
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        record(monkeypatch, tmp_path, archive_path, get=failing_get)
+
+    with gzip.open(archive_path, 'rt') as archive:
+        entries = json.load(archive)['entries']
+    assert entries[-1]['error']['type'] == 'requests.exceptions.ConnectionError'
+
+
+def test_jsonrpc_response_objects_are_archived(archive_path, monkeypatch):
+    class Response:
+        text = '{"jsonrpc": "2.0", "result": {"ledger_current_index": 55}, "id": 1}'
+
+    monkeypatch.setattr(indexer_health.jsonrpcclient, 'request', lambda url, method: Response())
+    with indexer_health.Transport(mode='record', archive_path=archive_path) as transport:
+        transport.jsonrpc_request('https://ripple.example.com', 'ledger_current')
+
+    replayed = indexer_health.Transport(mode='replay', archive_path=archive_path, speed=0)
+    response = replayed.jsonrpc_request('https://ripple.example.com', 'ledger_current')
+    assert response.text == Response.text
+    assert response.data.result == {'ledger_current_index': 55}
+
+
+def test_replay_speed(monkeypatch):
+    monkeypatch.delenv('INDEXER_HEALTH_REPLAY_SPEED', raising=False)
+    assert indexer_health.get_transport({'replaySpeed': None}).speed == 1.0
+    with pytest.raises(ValueError):
+        indexer_health.get_transport({'replaySpeed': -1})
+
+
+class MessageError(Exception):
+    def __init__(self, message):
+        super(MessageError, self).__init__(message)
+        self.message = message
+
+
+@pytest.mark.parametrize('error, has_message', [
+    (Exception("{'ledger_current_index': 55}}"), False),
+    (MessageError("{'ledger_current_index': 55}}"), True),
+])
+def test_replayed_errors_only_carry_message_if_recorded(monkeypatch, archive_path, error, has_message):
+    def failing_request(url, method):
+        raise error
+
+    monkeypatch.setattr(indexer_health.jsonrpcclient, 'request', failing_request)
+    with indexer_health.Transport(mode='record', archive_path=archive_path) as transport:
+        with pytest.raises(type(error)):
+            transport.jsonrpc_request('https://ripple.example.com', 'ledger_current')
+
+    replayed = indexer_health.Transport(mode='replay', archive_path=archive_path, speed=0)
+    with pytest.raises(indexer_health.ReplayedTransportError) as replayed_error:
+        replayed.jsonrpc_request('https://ripple.example.com', 'ledger_current')
+    assert hasattr(replayed_error.value, 'message') is has_message
+
+
+def test_crashed_run_still_writes_profile(monkeypatch, tmp_path):
+    def failing_get(url, timeout):
+        raise requests.exceptions.ConnectionError('connection refused')
+
+    monkeypatch.setattr(indexer_health.requests, 'get', failing_get)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        indexer_health.lambda_handler({'profile': True, 'outputDir': str(tmp_path)}, None)
+
+    summary_files = [f for f in os.listdir(str(tmp_path / 'profiles')) if f.endswith('-summary.json')]
+    assert len(summary_files) == 1
+    with open(str(tmp_path / 'profiles' / summary_files[0])) as summary_file:
+        stages = json.load(summary_file)['stages']
+    assert stages['setup']['calls'] == 1
+    assert stages['poll']['calls'] == 1
+
+
+@pytest.mark.parametrize('value, enabled', [
+    (True, True), ('true', True), (1, True), ('1', True),
+    (False, False), ('false', False), ('0', False), (0, False),
+])
+def test_profile_flag(monkeypatch, value, enabled):
+    monkeypatch.setenv('INDEXER_HEALTH_PROFILE', '1')
+    assert indexer_health.get_profiler({'profile': value}).enabled is enabled
+
+
+def test_profile_report(monkeypatch, tmp_path):
+    def slow_get(url, timeout):
+        time.sleep(0.005)
+        return fake_get(url, timeout)
+
+    monkeypatch.setattr(indexer_health.requests, 'get', slow_get)
+    indexer_health.lambda_handler({'profile': True, 'profileInterval': 0.001, 'outputDir': str(tmp_path)}, None)
+
+    profiles = sorted(os.listdir(str(tmp_path / 'profiles')))
+    with open(str(tmp_path / 'profiles' / [f for f in profiles if f.endswith('.collapsed')][0])) as collapsed_file:
+        lines = collapsed_file.read().splitlines()
+    with open(str(tmp_path / 'profiles' / [f for f in profiles if f.endswith('-summary.json')][0])) as summary_file:
+        summary = json.load(summary_file)
+
+    assert lines
+    for line in lines:
+        assert re.match(r'^(setup|poll|parse|publish|other)(;[^;]+)+ \d+$', line), line
+    assert summary['totalSeconds'] > 0
+    assert summary['samples'] == sum(int(line.rsplit(' ', 1)[1]) for line in lines)
+    assert summary['stages']['poll']['wallSeconds'] > 0
+    assert summary['stages']['parse']['wallSeconds'] > 0
+    assert summary['stages']['poll']['topFrames']
+
+
+@pytest.mark.parametrize('interval', [0, -0.001])
+def test_profile_interval_must_be_positive(interval):
+    with pytest.raises(ValueError):
+        indexer_health.get_profiler({'profile': True, 'profileInterval': interval})